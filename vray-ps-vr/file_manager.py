@@ -17,8 +17,24 @@ import os
 import subprocess
 import shutil
 import argparse
+import collections
 import logging
 import tempfile
+import threading
+import time
+import functools
+import concurrent.futures
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+
+import pythoncom  # pylint: disable=E0401
+
+try:
+    # Optional: exports jpegs straight from the merged psd
+    # preview without a round trip through photoshop.
+    from psd_tools import PSDImage  # pylint: disable=E0401
+except ImportError:
+    PSDImage = None
 
 import local_secrets as secrets
 import ps_macros
@@ -26,54 +42,127 @@ import ps_macros
 BASE_PATH = os.path.normpath(secrets.BASE_PATH)
 CARRIER = secrets.CARRIER
 KRPANO_PATH = secrets.KRPANO_PATH
-LAYER = ['Ambient_Occlusion', 'Glare']
+LAYER = frozenset(('Ambient_Occlusion', 'Glare'))
+_VALID_EXT = ('.png',)  # currently we render in png anyway
 
+@dataclass(frozen=True, slots=True)
+class CarrierPaths:
+    '''
+    Pre-joined directory paths of one carrier, so the
+    scan helpers do not rebuild them on every call.
+    '''
+    carrier: str
+    base: str
+    psds: str
+    renderings: str
+
+def _carrier_paths(carrier: str) -> CarrierPaths:
+    base = os.path.join(BASE_PATH, carrier)
+    return CarrierPaths(carrier,
+                        base,
+                        os.path.join(base, 'psds'),
+                        os.path.join(base, 'renderings'))
+
+_CACHE_TTL = 60  # seconds a directory listing stays valid
+_CACHE_SIZE = 32
+_cache_enabled = True
+_dir_cache: dict[str, tuple[float, list[os.DirEntry]]] = {}
+
+# There is only one photoshop instance and its scripting interface
+# works on the active document, so worker threads must not drive
+# it concurrently.
+_ps_lock = threading.Lock()
+
+def _cached_scandir(path: str) -> list[os.DirEntry]:
+    '''
+    Scan a directory and keep the entries in a small
+    in-process cache, so repeated scans of the same
+    path within the TTL do not hit the filesystem again.
+    '''
+    now = time.monotonic()
+    cached = _dir_cache.get(path)
+    if _cache_enabled and cached and now - cached[0] < _CACHE_TTL:
+        return cached[1]
+
+    with os.scandir(path) as it:
+        entries = list(it)
+
+    if len(_dir_cache) >= _CACHE_SIZE:
+        oldest = min(_dir_cache, key=lambda p: _dir_cache[p][0])
+        del _dir_cache[oldest]
+
+    _dir_cache[path] = (now, entries)
+
+    return entries
+
+@functools.cache
 def _setup_argparse() -> argparse.ArgumentParser:
     '''
-    Setup and return the argument parser.
+    Setup and return the argument parser. Built once
+    per process, repeated calls reuse the same parser.
+    One subcommand per task, so argparse itself rejects
+    conflicting combinations at parse time.
     '''
-    parser = argparse.ArgumentParser(prog='vtour File Manager',
-                                     description='Creates and updates psd files and krpano vr tours.',
-                                     epilog='Matthias Kneidinger (c) 2024 GPLv3')
+    common = argparse.ArgumentParser(add_help=False)
 
-    parser.add_argument('carrier',
+    common.add_argument('carrier',
                         help="which carrier should be processed, enter multiple if needed",
                         choices=CARRIER,
                         nargs='+',
                         type=str)
 
-    parser.add_argument('-i', '--info',
-                        help="print information about the latest renderings",
+    common.add_argument('-f', '--force',
+                        help="also process renderings whose psd file already exists",
                         action="store_true")
 
-    parser.add_argument('-c', '--create',
-                        help="creates new .psd files or vtour from the given renderings",
-                        choices=('images', 'vtour'),
-                        type=str)
+    common.add_argument('-j', '--jobs',
+                        help="number of parallel photoshop jobs, use with care",
+                        type=int,
+                        default=1)
 
-    parser.add_argument('-u', '--update',
-                        help="updates the existing .psd files or vtour with the latest renderings",
-                        choices=('images','backgrounds', 'vtour'),
-                        type=str)
+    common.add_argument('--stage-local',
+                        help="copy the jpgs to a local temp folder before building the vtour",
+                        action="store_true")
 
-    parser.add_argument('-s', '--save',
-                        help="save the existing .psd files as jpegs",
+    common.add_argument('--no-cache',
+                        help="always rescan directories instead of using cached listings",
                         action="store_true")
 
-    parser.add_argument('-v', '--verbose',
+    common.add_argument('-v', '--verbose',
                         help="print information during the process",
                         action="store_true")
 
-    parser.add_argument('-d', '--debug',
+    common.add_argument('-d', '--debug',
                         help="print the most detailed information",
                         action="store_true")
 
+    parser = argparse.ArgumentParser(prog='vtour File Manager',
+                                     description='Creates and updates psd files and krpano vr tours.',
+                                     epilog='Matthias Kneidinger (c) 2024 GPLv3')
+
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    subparsers.add_parser('info', parents=[common],
+                          help="print information about the latest renderings")
+    subparsers.add_parser('create-images', parents=[common],
+                          help="creates new .psd files from the given renderings")
+    subparsers.add_parser('create-vtour', parents=[common],
+                          help="creates a new vtour from the given renderings")
+    subparsers.add_parser('update-images', parents=[common],
+                          help="updates the existing .psd files with the latest renderings")
+    subparsers.add_parser('update-backgrounds', parents=[common],
+                          help="updates the backgrounds of the existing .psd files")
+    subparsers.add_parser('update-vtour', parents=[common],
+                          help="updates the existing vtour with the latest renderings")
+    subparsers.add_parser('save', parents=[common],
+                          help="save the existing .psd files as jpegs")
+
     return parser
 
 def _setup_logger(arguments: argparse.Namespace) -> logging.Logger:
     if arguments.debug:
         logging_level = logging.DEBUG
-    elif arguments.verbose or arguments.info:
+    elif arguments.verbose or arguments.cmd == 'info':
         logging_level = logging.INFO
     else:
         logging_level = logging.WARNING
@@ -95,141 +184,259 @@ def _setup_logger(arguments: argparse.Namespace) -> logging.Logger:
 
     return log
 
-def _output_info(carrier: str,
+def _output_info(paths: CarrierPaths,
                 log: logging.Logger) -> bool:
     '''
     Collect relevant information about the latest
     created folder of the currently selected carrier.
     Output the information via logs.
     '''
-    search_path = os.path.join(BASE_PATH, carrier, 'renderings')
-    search_path = _get_latest_entry(search_path)
+    search_path = _get_latest_entry(paths.renderings)
 
     if not search_path:
-        log.warning("No renderings entry for %s exists!" % carrier)
+        log.warning("No renderings entry for %s exists!", paths.carrier)
         return False
 
-    log.debug("Latest entry is: %s" % os.path.basename(search_path))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Latest entry is: %s", os.path.basename(search_path))
     count = 0
     names = []
-    layer_files = []
-
-    with os.scandir(search_path) as it:
-        for entry in it:
-            if not entry.name.startswith('.') and entry.is_file():
-                segments = entry.name.split('.')
-                if len(segments) > 2:
-                    if not segments[1] in layer_files:
-                        layer_files.append(segments[1])
-                else:
-                    count += 1
-                    names.append(segments[0])
-
-    log.info("%i Renderings:\nNames: %s\nLayers: %s" % (count,
-                                                        names,
-                                                        layer_files))
+    layer_files: set[str] = set()
+
+    # A pure name pass is enough here, no is_file() calls needed.
+    for entry in _cached_scandir(search_path):
+        name = entry.name
+        if name[:1] == '.' or '.' not in name:
+            continue
+
+        head, _, _ = name.rpartition('.')  # drop the extension
+        _, dot, layer = head.rpartition('.')
+
+        if dot:
+            layer_files.add(layer)
+        else:
+            count += 1
+            names.append(head)
+
+    log.info("%i Renderings:\nNames: %s\nLayers: %s",
+             count, names, sorted(layer_files))
     return True
 
 def _get_latest_entry(carrier_path: str) -> str:
-    entry_list = []
-    with os.scandir(carrier_path) as it:
-        for entry in it:
-            if entry.is_dir():
-                entry_list.append(entry.path)
+    # --no-cache has to bypass the memoized result as well, not
+    # just the directory listing cache underneath it.
+    if not _cache_enabled:
+        return _find_latest_entry(carrier_path)
 
-    if not entry_list:
-        return ''
+    return _memo_latest_entry(carrier_path)
 
-    entry_list.sort(reverse=True)
+@functools.lru_cache(maxsize=16)
+def _memo_latest_entry(carrier_path: str) -> str:
+    return _find_latest_entry(carrier_path)
 
-    return entry_list[0]
+def _find_latest_entry(carrier_path: str) -> str:
+    latest = max((entry for entry in _cached_scandir(carrier_path)
+                  if entry.is_dir(follow_symlinks=False)),
+                 key=lambda entry: entry.name,
+                 default=None)
 
-def _get_psds(carrier: str,
+    return latest.path if latest else ''
+
+def _scan_files(path: str,
+                suffix: str,
+                log: logging.Logger) -> Iterator[os.DirEntry]:
+    '''
+    Yield the regular files in a directory with the given
+    suffix. Shared scan loop of the file collectors; callers
+    that iterate only once may consume the generator directly.
+    '''
+    for entry in _cached_scandir(path):
+        name = entry.name
+        if name[:1] == '.' or not name.endswith(suffix):
+            continue
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        log.debug('Found file: %s', name)
+        yield entry
+
+def _get_psds(paths: CarrierPaths,
              log: logging.Logger) -> list[os.DirEntry]:
     '''
     Collect .psd file of the provided carrier.
     '''
-    psd_list = []
-    search_path = os.path.join(BASE_PATH, carrier, 'psds')
+    return list(_scan_files(paths.psds, '.psd', log))
 
-    with os.scandir(search_path) as it:
-        for entry in it:
-            if not entry.name.startswith('.') and entry.is_file():
-                if entry.name.endswith('.psd'):
-                    psd_list.append(entry)
-                    log.debug('Found file: %s' % entry.name)
-
-    return psd_list
-
-def _get_rendered_imgs(carrier: str,
-                       log: logging.Logger) -> dict[str, dict[str, os.DirEntry]]:
+def _get_rendered_imgs(paths: CarrierPaths,
+                       log: logging.Logger,
+                       wanted: set[str] | None = None) -> dict[str, dict[str, os.DirEntry]]:
     '''
     Collect all images that are in the latest render folder.
+    With wanted, only renderings whose stem is in that set
+    are parsed and kept.
     '''
-    file_tree: dict[str, dict[str, os.DirEntry]] = {}
+    file_tree: dict[str, dict[str, os.DirEntry]] = collections.defaultdict(dict)
 
-    search_path = os.path.join(BASE_PATH, carrier, 'renderings')
-    search_path = _get_latest_entry(search_path)
+    search_path = _get_latest_entry(paths.renderings)
 
     if not search_path:
-        log.warning("No renderings entry for %s exists!" % carrier)
+        log.warning("No renderings entry for %s exists!", paths.carrier)
         return {}
 
-    with os.scandir(search_path) as it:
-        for entry in it:
-            if not entry.name.startswith('.') and \
-            entry.is_file() and \
-            entry.name.endswith('.png'):  # currently we render in png anyway
-
-                segments = entry.name.split('.')
+    for entry in _cached_scandir(search_path):
+        name = entry.name
+        if name[:1] == '.' or \
+        not name.endswith(_VALID_EXT) or \
+        not entry.is_file(follow_symlinks=False):
+            continue
 
-                if segments[0] not in file_tree:
-                    file_tree[segments[0]] = {}
+        stem, _, _ = name.rpartition('.')  # drop the extension
+        base, dot, layer = stem.rpartition('.')
+        key = base if dot else stem
 
-                if len(segments) > 2 and segments[1] in LAYER:
-                    file_tree[segments[0]][segments[1]] = entry
-                    log.debug("Found layer file: %s" % entry.name)
+        if wanted is not None and key not in wanted:
+            continue
 
-                elif len(segments) == 2:
-                    file_tree[segments[0]]['base'] = entry
-                    log.debug("Found base file: %s" % entry.name)
+        if dot:
+            if layer in LAYER:
+                file_tree[key][layer] = entry
+                log.debug("Found layer file: %s", name)
+        else:
+            file_tree[key]['base'] = entry
+            log.debug("Found base file: %s", name)
 
-    log.info("Collected %i render files." % len(file_tree))
+    log.info("Collected %i render files.", len(file_tree))
 
     return file_tree
 
-def _create_local_vrtour(image_list,
-                         log: logging.Logger,
-                         krpano_stdout: bool = False):
+def _prefetch_stats(entries: Iterable[os.DirEntry]) -> None:
+    '''
+    Stat every file once through a thread pool, so the
+    photoshop opens that follow hit a warm directory cache
+    on the network share.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        for _ in executor.map(lambda entry: os.stat(entry.path), entries):
+            pass
+
+def _update_psds(paths: CarrierPaths,
+                 renderings: dict[str, dict[str, os.DirEntry]],
+                 log: logging.Logger,
+                 jobs: int = 1,
+                 background: bool = False) -> None:
+    '''
+    Update the smart layers of all psd files of a carrier
+    with the latest renderings. With jobs > 1 the files
+    are dispatched through a thread pool; photoshop is a
+    single instance, so the default stays serial and the
+    pool only overlaps the path preparation with the wait
+    for the previous file.
+    '''
+    psd_files = _get_psds(paths, log)
 
-    krpano_exe = os.path.join(KRPANO_PATH, 'krpanotools.exe')
-    krpano_config = os.path.join(KRPANO_PATH, 'templates', 'vtour-normal.config')
+    # Match psds with their renderings once up front, so the
+    # dispatch loop below only contains the photoshop call.
+    matched = [(psd.path, renderings[stem]) for psd in psd_files
+               if (stem := os.path.splitext(psd.name)[0]) in renderings]
 
-    process_return = subprocess.run([krpano_exe,
-                                     'makepano',
-                                     'config=',
-                                     krpano_config,
-                                     *image_list],
-                                     check=True,
-                                     shell=False,
-                                     capture_output=True)
+    missing = len(psd_files) - len(matched)
+    if missing:
+        log.warning("%i psd-files have no matching rendering.", missing)
 
-    if krpano_stdout:
-        log.info(process_return.stdout.decode())
+    _prefetch_stats(entry for _, img_layers in matched
+                    for entry in img_layers.values())
 
-def _save_psds_as_jpgs(carrier: str,
-                       log: logging.Logger) -> list[str]:
+    def _do_update(job: tuple[str, dict[str, os.DirEntry]]) -> None:
+        psd_path, img_layers = job
+        with _ps_lock:
+            ps_macros.update_all_smartlayer(psd_path, img_layers, log, background)
 
-    psd_files = _get_psds(carrier, log)
-    jpgs_remote = []
+    max_workers = max(1, min(jobs, len(matched)))
 
-    jpeg_dir = os.path.join(BASE_PATH, carrier, 'psds', 'JPEG')
+    # STA COM requires every worker thread to set up its own
+    # apartment before touching photoshop. Initializing once per
+    # thread keeps the cached COM handles valid across files;
+    # uninitializing per file would disconnect them.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            initializer=pythoncom.CoInitialize) as executor:
+        list(executor.map(_do_update, matched))
 
-    if not os.path.isdir(jpeg_dir):
-        os.mkdir(jpeg_dir)
+def _create_local_vrtour(image_list,
+                         log: logging.Logger,
+                         krpano_stdout: bool = False,
+                         output_dir: str = ''):
 
-    for psd in psd_files:
-        jpgs_remote.append(ps_macros.save_jpeg(psd, log, jpeg_dir))
+    krpano_exe = os.path.join(KRPANO_PATH, 'krpanotools.exe')
+    krpano_config = os.path.join(KRPANO_PATH, 'templates', 'vtour-normal.config')
+
+    krpano_args = [krpano_exe,
+                   'makepano',
+                   f'-config={krpano_config}',
+                   f'-jobs={os.cpu_count()}']
+    if output_dir:
+        krpano_args.append(f'-outputpath={output_dir}')
+
+    full_args = [*krpano_args, *image_list]
+
+    # Stream krpano's output line by line instead of buffering
+    # the whole run, so progress shows up while it encodes.
+    with subprocess.Popen(full_args,
+                          shell=False,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          text=True) as process:
+        for line in process.stdout:
+            if krpano_stdout:
+                log.info(line.rstrip())
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, full_args)
+
+def _save_psds_as_jpgs(paths: CarrierPaths,
+                       log: logging.Logger,
+                       jobs: int = 1) -> list[str]:
+
+    psd_files = _get_psds(paths, log)
+
+    jpeg_dir = os.path.join(paths.psds, 'JPEG')
+    os.makedirs(jpeg_dir, exist_ok=True)
+
+    # Warm the share's metadata cache up front; on SMB every
+    # later isfile/open starts with the same stat round-trip.
+    _prefetch_stats(psd_files)
+
+    def _do_save(psd: os.DirEntry, app=None) -> str:
+        # With psd-tools available, the merged preview stored in
+        # the psd is exported directly; photoshop is only needed
+        # for files that carry no composite.
+        if PSDImage is not None:
+            composite = PSDImage.open(psd.path).composite()
+            if composite is not None:
+                jpg_path = os.path.join(jpeg_dir, psd.name[:-4] + '.jpg')
+                composite.convert('RGB').save(jpg_path, 'JPEG',
+                                              quality=85, optimize=True)
+                log.debug("Saved file: %s", jpg_path)
+                return jpg_path
+
+        with _ps_lock:
+            return ps_macros.save_jpeg(psd, log, jpeg_dir, app)
+
+    max_workers = max(1, min(jobs, len(psd_files)))
+
+    if max_workers == 1:
+        # One session serves the whole serial batch, so the COM
+        # apartment and the photoshop handle stay alive between
+        # the files instead of being torn down per save.
+        with ps_macros.PhotoshopSession(log) as session:
+            return [_do_save(psd, session.app) for psd in psd_files]
+
+    # STA COM requires every worker thread to set up its own
+    # apartment before touching photoshop; one initialization per
+    # thread keeps the cached COM handles valid across files.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            initializer=pythoncom.CoInitialize) as executor:
+        jpgs_remote = list(executor.map(_do_save, psd_files))
 
     return jpgs_remote
 
@@ -238,17 +445,54 @@ def _get_jpgs(carrier: str,
     '''
     Collect .jpg files of the provided carrier.
     '''
-    jpg_list = []
     search_path = os.path.join(BASE_PATH, carrier, 'psds', 'JPEG')
 
-    with os.scandir(search_path) as it:
-        for entry in it:
-            if not entry.name.startswith('.') and entry.is_file():
-                if entry.name.endswith('.jpg'):
-                    jpg_list.append(entry)
-                    log.debug('Found file: %s' % entry.name)
+    return list(_scan_files(search_path, '.jpg', log))
+
+def _parallel_copytree(src: str,
+                       dst: str,
+                       workers: int = 8) -> None:
+    '''
+    Copy a directory tree like shutil.copytree, but fan the
+    per-file copies out over a thread pool. The vtour output
+    is mostly many small tiles, so overlapping the per-file
+    round-trips hides most of the network latency.
+    '''
+    copy_jobs = []
+    for root, _, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        for file_name in files:
+            copy_jobs.append((os.path.join(root, file_name),
+                              os.path.join(target_root, file_name)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda job: shutil.copy2(*job), copy_jobs))
+
+def _is_non_empty(path: str) -> bool:
+    '''
+    Check whether a directory contains anything without
+    enumerating the whole listing; the scan stops at the
+    first entry.
+    '''
+    with os.scandir(path) as it:
+        return next(it, None) is not None
 
-    return jpg_list
+def _move_or_copytree(src: str,
+                      dst: str) -> None:
+    '''
+    Move a directory tree to dst. When both ends live on the
+    same volume a rename is a single metadata operation, so it
+    is preferred over copying the bytes; across volumes the
+    threaded copy is used instead. The callers guarantee that
+    dst is empty if it exists.
+    '''
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        if os.path.isdir(dst):
+            os.rmdir(dst)
+        os.rename(src, dst)
+    else:
+        _parallel_copytree(src, dst)
 
 def _copy_vtour_to_remote(carrier: str,
                           log: logging.Logger,
@@ -257,17 +501,22 @@ def _copy_vtour_to_remote(carrier: str,
     vtour_dir = os.path.join(temp_dir, 'vtour')
     remote_dir = os.path.join(BASE_PATH, carrier, 'vtour')
 
-    if os.listdir(remote_dir):
+    if _is_non_empty(remote_dir):
         log.error('Attention: The vtour directory must be empty, to copy a' \
                   ' new tour there. Please make sure there are no files in it!')
     else:
-        shutil.copytree(vtour_dir, remote_dir, dirs_exist_ok=True)
+        _move_or_copytree(vtour_dir, remote_dir)
         log.info('Successfully copied the the new tour.')
 
 def _backup_panos_on_remote(carrier: str,
-                            log: logging.Logger):
-
+                            log: logging.Logger) -> str:
+    '''
+    Move the remote panos folder aside and leave an empty one in
+    its place. Returns the backup path, or an empty string when
+    there was nothing to back up.
+    '''
     remote_dir = os.path.join(BASE_PATH, carrier, 'vtour', 'panos')
+    backup_dir = ''
 
     if os.path.isdir(remote_dir):
 
@@ -277,9 +526,28 @@ def _backup_panos_on_remote(carrier: str,
             shutil.rmtree(backup_dir)
 
         os.rename(remote_dir, backup_dir)
+        log.debug('Renamed panos folder to: %s', backup_dir)
 
     os.mkdir(remote_dir)
-    log.debug('Renamed panos folder to: %s' % backup_dir)
+    return backup_dir
+
+def _restore_panos_backup(carrier: str,
+                          backup_dir: str,
+                          log: logging.Logger) -> None:
+    '''
+    Undo _backup_panos_on_remote: put the saved panos folder back
+    in place of the empty one left behind.
+    '''
+    if not backup_dir:
+        return
+
+    remote_dir = os.path.join(BASE_PATH, carrier, 'vtour', 'panos')
+
+    if os.path.isdir(remote_dir):
+        shutil.rmtree(remote_dir)
+
+    os.rename(backup_dir, remote_dir)
+    log.info('Restored the panos backup after the failed build.')
 
 def _copy_panos_to_remote(carrier: str,
                           log: logging.Logger,
@@ -288,11 +556,11 @@ def _copy_panos_to_remote(carrier: str,
     vtour_dir = os.path.join(temp_dir, 'vtour', 'panos')
     remote_dir = os.path.join(BASE_PATH, carrier, 'vtour', 'panos')
 
-    if os.listdir(remote_dir):
+    if _is_non_empty(remote_dir):
         log.error('Attention: The vtour/panos directory must be empty, to copy' \
                   ' new panos there. Please make sure there are no files in it!')
     else:
-        shutil.copytree(vtour_dir, remote_dir, dirs_exist_ok=True)
+        _parallel_copytree(vtour_dir, remote_dir)
         log.info('Successfully copied the the new tour.')
 
 def _copy_panos_to_combined(carrier: str,
@@ -301,52 +569,177 @@ def _copy_panos_to_combined(carrier: str,
 
     vtour_dir = os.path.join(temp_dir, 'vtour', 'panos')
     dir_name = '_'.join(('panos', carrier.lower()))
-    print(dir_name)
     remote_dir = os.path.join(BASE_PATH, 'COMBINED', 'vtour', dir_name)
 
-    if os.listdir(remote_dir):
+    if _is_non_empty(remote_dir):
         log.warning('Attention: The exisiting vtour/panos directory must be deleted,' \
                   ' to copy new panos there.')
         shutil.rmtree(remote_dir)
         os.mkdir(remote_dir)
 
-    shutil.copytree(vtour_dir, remote_dir, dirs_exist_ok=True)
+    # This runs concurrently with _copy_panos_to_remote, which
+    # reads the same staging directory, so the source must be
+    # copied here rather than renamed away.
+    _parallel_copytree(vtour_dir, remote_dir)
     log.info('Successfully copied the the new tour to COMBINED.')
 
+def _stage_jpgs(jpgs_remote: list[os.DirEntry],
+                tmpdir: str,
+                stage_local: bool) -> list[str]:
+    '''
+    Return the jpg paths krpano should read. By default the
+    remote files are passed directly and only the tour output
+    goes through the temp directory; with stage_local the jpgs
+    are copied to the temp directory first (useful on slow WAN
+    shares where krpano re-reads the sources several times).
+    '''
+    if not stage_local:
+        return [jpg.path for jpg in jpgs_remote]
+
+    jpgs_local = []
+    for jpg in jpgs_remote:
+        shutil.copy2(jpg, tmpdir)
+        jpgs_local.append(os.path.join(tmpdir, os.path.basename(jpg)))
+
+    return jpgs_local
+
 def _create_vrtour_to_remote(carrier: str,
-                             log: logging.Logger):
+                             log: logging.Logger,
+                             stage_local: bool = False):
 
     jpgs_remote = _get_jpgs(carrier, log)
 
-    jpgs_local = []
     with tempfile.TemporaryDirectory() as tmpdir:
-        for jpg in jpgs_remote:
-            shutil.copy2(jpg, tmpdir)
-            jpgs_local.append(os.path.join(tmpdir, os.path.basename(jpg)))
+        jpgs = _stage_jpgs(jpgs_remote, tmpdir, stage_local)
 
-        _create_local_vrtour(jpgs_local, log, False)
+        _create_local_vrtour(jpgs, log, False, os.path.join(tmpdir, 'vtour'))
         _copy_vtour_to_remote(carrier, log, tmpdir)
 
 def _update_vrtour_on_remote(carrier: str,
-                             log: logging.Logger):
+                             log: logging.Logger,
+                             stage_local: bool = False):
 
     jpgs_remote = _get_jpgs(carrier, log)
 
-    jpgs_local = []
     with tempfile.TemporaryDirectory() as tmpdir:
-        for jpg in jpgs_remote:
-            shutil.copy2(jpg, tmpdir)
-            jpgs_local.append(os.path.join(tmpdir, os.path.basename(jpg)))
+        jpgs = _stage_jpgs(jpgs_remote, tmpdir, stage_local)
+
+        # Futures instead of bare threads, so a failure in a
+        # worker propagates instead of vanishing with it.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # The backup is a pure remote rename, so it can run
+            # while krpano encodes the tour locally.
+            backup = executor.submit(_backup_panos_on_remote, carrier, log)
+
+            try:
+                _create_local_vrtour(jpgs, log, False, os.path.join(tmpdir, 'vtour'))
+            except Exception:
+                # The build failed after the live panos were already
+                # renamed away; put the backup back before giving up.
+                if backup.exception() is None:
+                    _restore_panos_backup(carrier, backup.result(), log)
+                raise
+
+            backup_dir = backup.result()
+
+            # Both copies only read from tmpdir, so they can push
+            # to the two remote targets at the same time.
+            combined = executor.submit(_copy_panos_to_combined, carrier, log, tmpdir)
+            _copy_panos_to_remote(carrier, log, tmpdir)
+            combined.result()
+
+        if backup_dir:
+            delete_backup = input("Do you want to delete the backup? (Y/N): ") or 'y'
+            if delete_backup.lower() == 'y':
+                shutil.rmtree(backup_dir)
+
+
+def _handle_create_images(paths: CarrierPaths,
+                          args: argparse.Namespace,
+                          log: logging.Logger,
+                          renderings: dict[str, dict[str, os.DirEntry]],
+                          backgrounds: dict[str, dict[str, os.DirEntry]]) -> None:
+    out_path = paths.psds
+    out_name = os.path.basename(out_path)
+
+    # Skip renderings whose psd already exists, photoshop
+    # refuses to overwrite them anyway.
+    existing: set[str] = set()
+    if not args.force:
+        existing = {os.path.splitext(psd.name)[0]
+                    for psd in _get_psds(paths, log)}
+
+    for file_key, file_entry in renderings.items():
+        if file_key in existing:
+            log.debug("Skipped %s, the psd-file already exists.", file_key)
+            continue
+
+        bg_file = backgrounds.get(file_key, None)
+
+        status = ps_macros.create_new_psd(file_entry, out_path, log, bg_file)
+        if not status:
+            break
+
+        log.info("Created psd-file: %s", out_name)
+    log.info("All psd-files are created.")
+
+def _handle_create_vtour(paths, args, log, renderings, backgrounds) -> None:
+    _create_vrtour_to_remote(paths.carrier, log, args.stage_local)
+
+def _handle_update_images(paths, args, log, renderings, backgrounds) -> None:
+    _update_psds(paths, renderings, log, args.jobs)
+
+def _handle_update_backgrounds(paths, args, log, renderings, backgrounds) -> None:
+    _update_psds(paths, renderings, log, args.jobs, True)
+
+def _handle_update_vtour(paths, args, log, renderings, backgrounds) -> None:
+    _update_vrtour_on_remote(paths.carrier, log, args.stage_local)
+
+def _handle_save(paths, args, log, renderings, backgrounds) -> None:
+    _save_psds_as_jpgs(paths, log, args.jobs)
+
+# One handler per subcommand; dispatching through the dict
+# replaces the former if/elif chain in the per-carrier loop.
+HANDLERS = {
+    'create-images': _handle_create_images,
+    'create-vtour': _handle_create_vtour,
+    'update-images': _handle_update_images,
+    'update-backgrounds': _handle_update_backgrounds,
+    'update-vtour': _handle_update_vtour,
+    'save': _handle_save,
+}
+
+# Subcommands that actually consume the latest renderings.
+_RENDERING_CMDS = frozenset(('create-images', 'update-images', 'update-backgrounds'))
+
+def _process_carrier(active_carrier: str,
+                     args: argparse.Namespace,
+                     log: logging.Logger,
+                     backgrounds: dict[str, dict[str, os.DirEntry]]) -> None:
+    '''
+    Run the requested command for one carrier. The carriers
+    are independent of each other, so this function may be
+    dispatched concurrently for commands that do not drive
+    photoshop. The backgrounds are shared by all carriers and
+    are collected once by the caller.
+    '''
+    paths = _carrier_paths(active_carrier)
 
-        _create_local_vrtour(jpgs_local, log, False)
-        _backup_panos_on_remote(carrier, log)
-        _copy_panos_to_remote(carrier, log, tmpdir)
-        _copy_panos_to_combined(carrier, log, tmpdir)
+    log.info("Carrier: %s", active_carrier)
+
+    # The update modes only need renderings that belong to an
+    # existing psd; everything else can be skipped while parsing.
+    wanted = None
+    if args.cmd in ('update-images', 'update-backgrounds'):
+        wanted = {os.path.splitext(psd.name)[0]
+                  for psd in _get_psds(paths, log)}
+
+    if args.cmd in _RENDERING_CMDS:
+        renderings = _get_rendered_imgs(paths, log, wanted)
+    else:
+        renderings = {}
 
-        delete_backup = input("Do you want to delete the backup? (Y/N): ") or 'y'
-        if delete_backup.lower() == 'y':
-            backup_path = os.path.join(BASE_PATH, carrier, 'vtour', 'panos_backup')
-            shutil.rmtree(backup_path)
+    HANDLERS[args.cmd](paths, args, log, renderings, backgrounds)
 
 
 def main() -> None:
@@ -363,58 +756,56 @@ def main() -> None:
     log.info("Base Path: %s", BASE_PATH)
     log.debug("Arguments given: %s", args)
 
-    if 'ALL' in args.carrier:
-        carrier_list = CARRIER[:-2]
-    else:
-        carrier_list = tuple(filter(lambda x: (x != 'BACKGROUNDS'), args.carrier))
-
-    for carr in carrier_list:
-
-        active_carrier = carr
-
-        log.info("Carrier: %s", active_carrier)
-
-        if args.info:
-            _output_info(active_carrier, log)
-            return
+    # The caches speed up repeated scans within one run; a new
+    # run should always see the current state of the share.
+    _memo_latest_entry.cache_clear()
+    _dir_cache.clear()
 
-        renderings = _get_rendered_imgs(active_carrier, log)
-        backgrounds = _get_rendered_imgs('BACKGROUNDS', log)
+    if args.no_cache:
+        global _cache_enabled
+        _cache_enabled = False
 
-        if args.create == 'images':
-            for file_key, file_entry in renderings.items():
-                out_path = os.path.join(BASE_PATH, active_carrier, 'psds')
-                bg_file = backgrounds.get(file_key, None)
-
-                status = ps_macros.create_new_psd(file_entry, out_path, log, bg_file)
-                if not status:
-                    break
-
-                log.info("Created psd-file: %s", os.path.basename(out_path))
-            log.info("All psd-files are created.")
-
-        elif args.create == 'vtour':
-            _create_vrtour_to_remote(active_carrier, log)
-
-        elif args.update == 'images':
-            psd_files = _get_psds(active_carrier, log)
-            for psdfile in psd_files:
-                psd_name = os.path.splitext(psdfile.name)[0]
-                if psd_name in renderings:
-                    ps_macros.update_all_smartlayer(psdfile, renderings[psd_name], log)
-
-        elif args.update == 'backgrounds':
-            psd_files = _get_psds(active_carrier, log)
-            for psdfile in psd_files:
-                psd_name = os.path.splitext(psdfile.name)[0]
-                if psd_name in renderings:
-                    ps_macros.update_all_smartlayer(psdfile, renderings[psd_name], log, True)
-
-        elif args.update == 'vtour':
-            _update_vrtour_on_remote(active_carrier, log)
-
-        elif args.save:
-            _save_psds_as_jpgs(active_carrier, log)
+    # The pseudo entries are dropped explicitly by name, so the
+    # selection no longer depends on their position in CARRIER.
+    if 'ALL' in args.carrier:
+        carrier_list = tuple(c for c in CARRIER if c not in ('BACKGROUNDS', 'ALL'))
+    else:
+        carrier_list = tuple(c for c in args.carrier if c != 'BACKGROUNDS')
+
+    # Dropping the pseudo entries can leave nothing to work on,
+    # e.g. when only BACKGROUNDS was given.
+    if not carrier_list:
+        log.warning("No carrier selected, nothing to do.")
+        return
+
+    if args.cmd == 'info':
+        _output_info(_carrier_paths(carrier_list[0]), log)
+        return
+
+    # The backgrounds do not depend on the carrier, so they are
+    # scanned once here instead of once per carrier. Only the
+    # create-images mode uses them.
+    if args.cmd == 'create-images':
+        backgrounds = _get_rendered_imgs(_carrier_paths('BACKGROUNDS'), log)
+    else:
+        backgrounds = {}
+
+    # Creating a vtour only runs krpano and file copies, so those
+    # carriers may be processed concurrently. Everything that talks
+    # to the single photoshop instance stays serial, as does the
+    # vtour update with its interactive backup prompt.
+    if args.jobs > 1 and args.cmd == 'create-vtour':
+        max_workers = min(args.jobs, len(carrier_list))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_process_carrier, carr, args, log, backgrounds)
+                       for carr in carrier_list]
+            # Re-raise any worker failure; otherwise a failed krpano
+            # build would still report a successful run.
+            for future in futures:
+                future.result()
+    else:
+        for carr in carrier_list:
+            _process_carrier(carr, args, log, backgrounds)
 
     log.info("Script finished successfully.")
 
@@ -7,6 +7,7 @@ from pywintypes import com_error  # pylint: disable=E0611
 
 PS_NORMAL_LAYER = 1  # from enum PsLayerKind
 PS_SMART_OBJECTLAYER = 17  # from enum PsLayerKind
+PS_PIXEL_LAYERS = frozenset((PS_NORMAL_LAYER, PS_SMART_OBJECTLAYER))
 
 PS_MOVIE_PRIME = 5  # from enum PsLensType
 PS_PRIME_105 = 3  # from enum PsLensType
@@ -29,7 +30,7 @@ def add_lensflare_to_layer():
     blend_brightness = 10  # in percent
     blend_pos = (0, 0)
 
-    if active_layer.Kind in (PS_NORMAL_LAYER, PS_SMART_OBJECTLAYER):
+    if active_layer.Kind in PS_PIXEL_LAYERS:
         for item in doc_ref.CountItems:
             blend_pos = item.Position
             active_layer.ApplyLensFlare(blend_brightness, blend_pos, PS_PRIME_105)
@@ -32,7 +32,10 @@ create_new_psd()
 
 import os
 import os.path
+import json
 import logging
+import struct
+import threading
 from collections.abc import Callable
 
 import win32com.client as win32
@@ -52,10 +55,66 @@ PS_JPEG_SAVE = 6
 PS_NO_MATTE = 1
 PS_WHITE_MATTE = 4
 PS_OPTIMIZED_BASELINE = 2
+PS_EXPORT_SAVE_FOR_WEB = 2
+PS_SAVE_FOR_WEB_JPEG = 6
+
+# Maps the photoshop layer names to the rendering layer keys;
+# extra passes (specular, depth, ...) only need one more entry.
+_LAYER_KEY_MAP = {'base': 'base',
+                  'glare': 'Glare',
+                  'ambient': 'Ambient_Occlusion'}
+
+# Runs the whole replace loop inside photoshop, so L layers
+# cost one COM transition instead of roughly three each.
+_JSX_REPLACE_LAYERS = '''
+var doc = app.activeDocument;
+var group = null;
+for (var i = 0; i < doc.layerSets.length; i++) {
+    if (doc.layerSets[i].name === %(group)s) { group = doc.layerSets[i]; break; }
+}
+if (group) {
+    var paths = %(paths)s;
+    var idNull = charIDToTypeID('null');
+    var idReplace = stringIDToTypeID('placedLayerReplaceContents');
+    for (var j = 0; j < group.artLayers.length; j++) {
+        var layer = group.artLayers[j];
+        var path = paths[layer.name];
+        if (path) {
+            doc.activeLayer = layer;
+            var desc = new ActionDescriptor();
+            desc.putPath(idNull, new File(path));
+            executeAction(idReplace, desc, DialogModes.NO);
+        }
+    }
+}
+'''
+
+class PhotoshopSession:
+    '''
+    Context manager that attaches to photoshop once and hands
+    the same application handle to a whole batch of calls, so
+    the per-call startup cost is paid a single time.
+
+    with PhotoshopSession(log) as session:
+        for file in files:
+            save_jpeg(file, log, app=session.app)
+    '''
+
+    def __init__(self, log: logging.Logger) -> None:
+        self.log = log
+        self.app: Callable | None = None
+
+    def __enter__(self) -> 'PhotoshopSession':
+        self.app = _prepare_photoshop(self.log)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.app = None
 
 def save_jpeg(psd_file: os.DirEntry,
               log: logging.Logger,
-              output_dir: str = '') -> str:
+              output_dir: str = '',
+              app: Callable | None = None) -> str:
 
     '''
     Saves a given .psd as a .jpg.
@@ -69,13 +128,16 @@ def save_jpeg(psd_file: os.DirEntry,
     output_dir: str
         Optional output directory path
         Otherwise same as input path
+    app: Optional[Callable]
+        Reuse an already attached photoshop handle,
+        e.g. from a PhotoshopSession
 
     Returns
     -------
     None
     '''
 
-    app = _prepare_photoshop(log)
+    app = app or _prepare_photoshop(log)
     if not app:
         return ''
     doc = app.Open(psd_file.path)
@@ -95,72 +157,91 @@ def _save_as_jpg(ps_doc,
                  output_file_path,
                  log: logging.Logger) -> None:
 
-    if not os.path.isdir(os.path.dirname(output_file_path)):
-        os.mkdir(os.path.dirname(output_file_path))
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
 
-    jpeg_options = win32.gencache.EnsureDispatch('Photoshop.JPEGSaveOptions')
-    jpeg_options.EmbedColorProfile = True
-    jpeg_options.FormatOptions = PS_OPTIMIZED_BASELINE
-    jpeg_options.Matte = PS_WHITE_MATTE
-    jpeg_options.Quality = 12
+    try:
+        # The save-for-web export skips the EXIF, thumbnail and
+        # color management work of the full photoshop save path.
+        ps_doc.Export(output_file_path, PS_EXPORT_SAVE_FOR_WEB, _web_export_opts())
+    except com_error:
+        ps_doc.SaveAs(output_file_path, _get_jpeg_opts(),
+                      AsCopy=True, ExtensionType=PS_LOWERCASE)
 
-    ps_doc.SaveAs(output_file_path, jpeg_options, AsCopy=True, ExtensionType=PS_LOWERCASE)
-    log.debug("Saved file: %s" % output_file_path)
+    log.debug("Saved file: %s", output_file_path)
 
-def update_all_smartlayer(psd_file: os.DirEntry,
+def update_all_smartlayer(psd_path: str,
                           img_layers: dict[str, os.DirEntry],
                           log: logging.Logger,
-                          background: bool = False) -> bool:
+                          background: bool = False,
+                          app: Callable | None = None) -> bool:
     '''
     Replace the images of all specified smart object layers
 
     Parameters
     ----------
-    psd_file: os.DirEntry
-        Which psd to update
+    psd_path: str
+        Full path of the psd to update
     img_layers: dict[str, os.DirEntry]
         A dictionary with different layers of a rendering
     log: logging.Logger
     background: bool = False
         If True, updates the background group, otherwise
         the main content group
+    app: Optional[Callable]
+        Reuse an already attached photoshop handle,
+        e.g. from a PhotoshopSession
 
     Returns
     -------
     bool
     '''
 
-    app = _prepare_photoshop(log)
+    app = app or _prepare_photoshop(log)
     if not app:
         return False
 
-    doc = app.Open(psd_file.path)
+    doc = app.Open(psd_path)
 
-    group = None
     group_to_find = 'background' if background else 'content'
 
-    for ls in doc.LayerSets:
-        if ls.Name == group_to_find:
-            group = ls
-            break
+    # Fetch the names in one pass and grab the set by index;
+    # iterating a COM collection costs a round-trip per item.
+    group_names = [ls.Name for ls in doc.LayerSets]
+    try:
+        group = doc.LayerSets.Item(group_names.index(group_to_find) + 1)
+    except ValueError:
+        group = None
 
     if not group:
         doc.Close()
         return False
 
-    for layer in group.ArtLayers:
-        doc.ActiveLayer = layer
-        if layer.Name == 'base':
-            _replace_image_smart_layer(app, img_layers['base'].path)
-        elif layer.Name == 'glare':
-            _replace_image_smart_layer(app, img_layers['Glare'].path)
-        elif layer.Name == 'ambient':
-            _replace_image_smart_layer(app, img_layers['Ambient_Occlusion'].path)
+    paths = {name: img_layers[key].path
+             for name, key in _LAYER_KEY_MAP.items()
+             if key in img_layers}
+
+    # json.dumps doubles as the escaping for the jsx literals.
+    jsx_code = _JSX_REPLACE_LAYERS % {'group': json.dumps(group_to_find),
+                                      'paths': json.dumps(paths)}
+
+    try:
+        app.DoJavaScript(jsx_code)
+    except com_error:
+        # Scripting may be disabled; replace the layers one by
+        # one over COM instead. The names are fetched up front
+        # for the same reason as the group names above.
+        layer_names = [layer.Name for layer in group.ArtLayers]
+        for idx, name in enumerate(layer_names, 1):
+            key = _LAYER_KEY_MAP.get(name)
+            if not key or key not in img_layers:
+                continue
+            doc.ActiveLayer = group.ArtLayers.Item(idx)
+            _replace_image_smart_layer(app, img_layers[key].path)
 
     doc.Save()
 
-    output_name = psd_file.name[:-4] + '.jpg'
-    output_path = os.path.join(os.path.dirname(psd_file.path), 'JPEG', output_name)
+    output_name = os.path.basename(psd_path)[:-4] + '.jpg'
+    output_path = os.path.join(os.path.dirname(psd_path), 'JPEG', output_name)
     _save_as_jpg(doc, output_path, log)
 
     doc.Close()
@@ -170,7 +251,8 @@ def update_all_smartlayer(psd_file: os.DirEntry,
 def create_new_psd(img_layers: dict[str, os.DirEntry],
                    output_path: str,
                    log: logging.Logger,
-                   bg_layers: dict[str, os.DirEntry] | None = None) -> bool:
+                   bg_layers: dict[str, os.DirEntry] | None = None,
+                   app: Callable | None = None) -> bool:
     '''
     Creates a new psd file in the right directory based
     on the latest rendered images
@@ -183,13 +265,16 @@ def create_new_psd(img_layers: dict[str, os.DirEntry],
     log: logging.Logger
     bg_layers: Optional[dict[str, os.DirEntry]]
         Also add a background group to the psd file
+    app: Optional[Callable]
+        Reuse an already attached photoshop handle,
+        e.g. from a PhotoshopSession
 
     Returns
     -------
     bool
     '''
 
-    app = _prepare_photoshop(log)
+    app = app or _prepare_photoshop(log)
     if not app:
         return False
 
@@ -206,13 +291,25 @@ def create_new_psd(img_layers: dict[str, os.DirEntry],
     start_ruler_units = app.Preferences.RulerUnits
     app.Preferences.RulerUnits = PS_PIXEL
 
-    # Open image file to get its resolution via photoshop
-    doc = app.Open(img_layers['base'].path)
-    width, height = doc.Width, doc.Height
-    doc.Close()
+    # Every place action normally snapshots the document into
+    # the history; one state is enough while the layer stacks
+    # are built and saves photoshop a lot of internal copying.
+    start_history_states = app.Preferences.NumberOfHistoryStates
+    app.Preferences.NumberOfHistoryStates = 1
+
+    # Read the resolution from the png header, opening the
+    # file in photoshop would decode the whole image.
+    try:
+        width, height = _png_size(img_layers['base'].path)
+    except ValueError:
+        # Renders in other formats go through photoshop again,
+        # that opens the whole image but works for everything.
+        size_doc = app.Open(img_layers['base'].path)
+        width, height = size_doc.Width, size_doc.Height
+        size_doc.Close()
 
     doc_ref = app.Documents.Add(width, height, 72.0, filename)
-    log.debug("Created new document in photoshop with the name: '%s'" % filename)
+    log.debug("Created new document in photoshop with the name: '%s'", filename)
 
     if bg_layers:
         _insert_render_stack(app, doc_ref, bg_layers, 'background', log)
@@ -225,20 +322,143 @@ def create_new_psd(img_layers: dict[str, os.DirEntry],
     _save_as_jpg(doc_ref, output_jpg, log)
 
     doc_ref.Close()
-    log.info("Created and saved file: %s.psd" % filename)
+    log.info("Created and saved file: %s.psd", filename)
 
     # Make sure to set the ruler units prior to creating the document.
+    app.Preferences.NumberOfHistoryStates = start_history_states
     app.Preferences.RulerUnits = start_ruler_units
 
     return True
 
 
+# COM proxies must not cross apartment boundaries, so the
+# cached photoshop handle is kept per thread.
+_ps_local = threading.local()
+
+def reset_photoshop() -> None:
+    '''
+    Drop the cached photoshop handle of the current thread,
+    e.g. after photoshop was restarted and the COM link died.
+    '''
+    _ps_local.app = None
+    _ps_local.desc = None
+    _ps_local.sids = None
+    _ps_local.cids = None
+    _ps_local.web_opts = None
+    _ps_local.jpeg_opts = None
+
+def _sid(app: Callable, name: str) -> int:
+    '''
+    Cached StringIDToTypeID lookup. The ids are constant for
+    a photoshop instance, so each string only crosses the COM
+    boundary once per thread.
+    '''
+    ids = getattr(_ps_local, 'sids', None)
+    if ids is None:
+        ids = _ps_local.sids = {}
+
+    type_id = ids.get(name)
+    if type_id is None:
+        type_id = ids[name] = app.StringIDToTypeID(name)
+
+    return type_id
+
+def _cid(app: Callable, code: str) -> int:
+    '''
+    Cached CharIDToTypeID lookup, see _sid().
+    '''
+    ids = getattr(_ps_local, 'cids', None)
+    if ids is None:
+        ids = _ps_local.cids = {}
+
+    type_id = ids.get(code)
+    if type_id is None:
+        type_id = ids[code] = app.CharIDToTypeID(code)
+
+    return type_id
+
+def _get_jpeg_opts() -> Callable:
+    '''
+    Return the reusable JPEGSaveOptions of the current thread,
+    see _web_export_opts().
+    '''
+    opts = getattr(_ps_local, 'jpeg_opts', None)
+    if opts is None:
+        opts = win32.gencache.EnsureDispatch('Photoshop.JPEGSaveOptions')
+        opts.EmbedColorProfile = True
+        opts.FormatOptions = PS_OPTIMIZED_BASELINE
+        opts.Matte = PS_WHITE_MATTE
+        opts.Quality = 12
+        _ps_local.jpeg_opts = opts
+
+    return opts
+
+def _web_export_opts() -> Callable:
+    '''
+    Return the reusable save-for-web export options of the
+    current thread; the settings are static for this usecase,
+    so the COM object is built and configured only once.
+    '''
+    opts = getattr(_ps_local, 'web_opts', None)
+    if opts is None:
+        opts = win32.gencache.EnsureDispatch('Photoshop.ExportOptionsSaveForWeb')
+        opts.Format = PS_SAVE_FOR_WEB_JPEG
+        opts.Quality = 80
+        opts.Optimized = True
+        opts.IncludeProfile = False
+        _ps_local.web_opts = opts
+
+    return opts
+
+def _empty_desc() -> Callable:
+    '''
+    Return a reusable empty ActionDescriptor. Clear() resets
+    it in place, so the COM object is dispatched only once
+    per thread instead of once per action.
+    '''
+    desc = getattr(_ps_local, 'desc', None)
+    if desc is None:
+        desc = win32.gencache.EnsureDispatch('Photoshop.ActionDescriptor')
+        _ps_local.desc = desc
+
+    desc.Clear()
+
+    return desc
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _png_size(img_path: str) -> tuple[int, int]:
+    '''
+    Read width and height of a png straight from its IHDR
+    chunk, which sits at a fixed offset behind the signature.
+    Raises ValueError if the file is not a png.
+    '''
+    with open(img_path, 'rb') as img_file:
+        header = img_file.read(24)
+
+    if header[:8] != _PNG_SIGNATURE or header[12:16] != b'IHDR':
+        raise ValueError(f"Not a png file: {img_path}")
+
+    width, height = struct.unpack('>II', header[16:24])
+
+    return width, height
+
 def _prepare_photoshop(log: logging.Logger) ->Callable | None:
+    app = getattr(_ps_local, 'app', None)
+    if app is not None:
+        return app
+
     try:
         app = win32.gencache.EnsureDispatch("Photoshop.Application")
     except com_error:
         log.warning("Photoshop Error: Couldn't access Photoshop. Please make sure that the application is running.")
         return None
+    except (AttributeError, TypeError):
+        # A stale gencache makes EnsureDispatch fail even though
+        # photoshop itself is reachable; late binding skips the
+        # typelib generation and still works, just a bit slower.
+        app = win32.Dispatch("Photoshop.Application")
+        log.debug("Falling back to late-bound photoshop dispatch.")
 
     log.debug("Successfully attached photoshop.")
 
@@ -248,25 +468,33 @@ def _prepare_photoshop(log: logging.Logger) ->Callable | None:
         log.warning("Photoshop Error: Please make sure that photoshop is running and that you are logged in.")
         return None
 
+    _ps_local.app = app
+
     return app
 
 def _insert_render_stack(app: Callable,
                          doc: Callable, img_layers: dict[str, os.DirEntry], groupname:str,
                          log: logging.Logger) -> tuple[str, Callable, Callable, Callable, Callable]:
 
+    # Resolve the entry paths once up front; DirEntry.path is
+    # built lazily on first access.
+    base_path = img_layers['base'].path
+    ambient_entry = img_layers.get('Ambient_Occlusion')
+    glare_entry = img_layers.get('Glare')
+
     base_group = _create_new_group(doc, groupname, log)
-    base_layer = _create_new_smart_layer(app, doc, base_group, 'base', log)
-    _replace_image_smart_layer(app, img_layers['base'].path)
+    base_layer = _place_image_smart_layer(app, doc, base_group, 'base',
+                                          base_path, log)
 
-    if 'Ambient_Occlusion' in img_layers:
-        ambient_layer = _create_new_smart_layer(app, doc, base_group, 'ambient', log)
-        _replace_image_smart_layer(app, img_layers['Ambient_Occlusion'].path)
+    if ambient_entry is not None:
+        ambient_layer = _place_image_smart_layer(app, doc, base_group, 'ambient',
+                                                 ambient_entry.path, log)
         ambient_layer.BlendMode = PS_BLEND_MODE_MULTIPLY
         ambient_layer.Opacity = 70.0
 
-    if 'Glare' in img_layers:
-        glare_layer = _create_new_smart_layer(app, doc, base_group, 'glare', log)
-        _replace_image_smart_layer(app, img_layers['Glare'].path)
+    if glare_entry is not None:
+        glare_layer = _place_image_smart_layer(app, doc, base_group, 'glare',
+                                               glare_entry.path, log)
         glare_layer.BlendMode = PS_BLEND_MODE_SCREEN
         glare_layer.Opacity = 40.0
 
@@ -284,8 +512,8 @@ def _create_new_smart_layer(app, doc, group, name:str, log: logging.Logger) -> C
     layer_ref = group.ArtLayers.Add()
     layer_ref.Kind = PS_NORMAL_LAYER
 
-    desc = win32.gencache.EnsureDispatch('Photoshop.ActionDescriptor')  # empty descriptor
-    app.ExecuteAction(app.StringIDToTypeID("newPlacedLayer"), desc, PS_DISPLAY_NO_DIALOGS)
+    desc = _empty_desc()
+    app.ExecuteAction(_sid(app, "newPlacedLayer"), desc, PS_DISPLAY_NO_DIALOGS)
 
     layer_ref = doc.ActiveLayer
     layer_ref.Name = name
@@ -293,10 +521,32 @@ def _create_new_smart_layer(app, doc, group, name:str, log: logging.Logger) -> C
 
     return layer_ref
 
+def _place_image_smart_layer(app: Callable, doc, group, name: str,
+                             img_path: str, log: logging.Logger) -> Callable:
+    layer_ref = group.ArtLayers.Add()
+    layer_ref.Kind = PS_NORMAL_LAYER
+    doc.ActiveLayer = layer_ref
+
+    # A single 'Plc ' (placeEvent) action creates the smart object
+    # and loads the image in one COM round-trip, instead of the
+    # newPlacedLayer + placedLayerReplaceContents pair.
+    desc = _empty_desc()
+    desc.PutPath(_cid(app, 'null'), img_path)
+    desc.PutEnumerated(_cid(app, 'FTcs'),
+                       _cid(app, 'QCSt'),
+                       _cid(app, 'Qcsa'))
+    app.ExecuteAction(_cid(app, 'Plc '), desc, PS_DISPLAY_NO_DIALOGS)
+
+    layer_ref = doc.ActiveLayer
+    layer_ref.Name = name
+    log.debug("Placed a new smart object layer with the name: %s", name)
+
+    return layer_ref
+
 def _replace_image_smart_layer(app: Callable, new_img_path: str) -> None:
-    id_replace = app.StringIDToTypeID('placedLayerReplaceContents')
-    desc = win32.gencache.EnsureDispatch('Photoshop.ActionDescriptor')  # empty descriptor
-    desc.PutPath(app.CharIDToTypeID('null'), new_img_path)
+    id_replace = _sid(app, 'placedLayerReplaceContents')
+    desc = _empty_desc()
+    desc.PutPath(_cid(app, 'null'), new_img_path)
     app.ExecuteAction(id_replace, desc, PS_DISPLAY_NO_DIALOGS)
 
 
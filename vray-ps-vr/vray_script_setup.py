@@ -36,8 +36,14 @@ render_scene(bool)
 '''
 
 import os.path
-from datetime import datetime
+from datetime import date, datetime
+import functools
+import hashlib
 import logging
+import logging.handlers
+import queue
+import re
+import shutil
 
 import rhinoscriptsyntax as rs
 import rh8VRay as vray
@@ -47,30 +53,49 @@ import local_secrets as secrets
 VR_RENDERSETTINGS = os.path.normpath(secrets.VR_SETTINGS_PATH)
 NORMAL_RENDERSETTINGS = os.path.normpath(secrets.STD_SETTINGS_PATH)
 BASE_PATH = os.path.normpath(secrets.BASE_PATH)
-CARRIER = secrets.CARRIER
+CARRIER = frozenset(secrets.CARRIER)
 FILENAME = rs.DocumentName()
 FILEPATH = rs.DocumentPath()
 
-def _setup_logging(dir_path: str) -> logging.Logger:
+# Pre-joined renderings directories, one per carrier, so the
+# call sites do a dict hit instead of rebuilding the path.
+RENDERINGS_ROOT = {carrier: os.path.join(BASE_PATH, carrier, 'renderings')
+                   for carrier in CARRIER}
+
+def _setup_logging(dir_path: str) -> tuple[logging.Logger, logging.handlers.QueueListener]:
     logger = logging.getLogger('vray-mang')
     logger.setLevel(logging.DEBUG)
 
     log_path = os.path.join(dir_path, 'vray_render.log')
-    handler = logging.FileHandler(log_path, mode='a')
+    file_handler = logging.FileHandler(log_path, mode='a')
     formatter = logging.Formatter('%(asctime)s: %(name)s: %(levelname)s: %(message)s')
+    file_handler.setFormatter(formatter)
+
+    # Log calls only enqueue the record; the listener thread
+    # owns the blocking file writes, which matters when the
+    # log sits on a network share next to the renderings.
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
 
     logger.debug("Logger has been set up. Path to log file:")
     logger.debug(log_path)
 
-    return logger
+    return logger, listener
 
-def _close_logging(log: logging.Logger) -> None:
+def _close_logging(log: logging.Logger,
+                   listener: logging.handlers.QueueListener) -> None:
     log.debug("Closing logger, final message.")
 
-    for handler in log.handlers:
+    # stop() drains the queue before the file handler closes.
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+    # Iterate over a snapshot, removeHandler mutates the list.
+    for handler in list(log.handlers):
         log.removeHandler(handler)
         handler.close()
 
@@ -79,31 +104,30 @@ def _render_view(view: str, log: logging.Logger) -> None:
     rs.Redraw()
 
     t_start = datetime.now()
-    log.info(f"Start render at: {t_start}")
+    log.info("Start render at: %s", t_start)
 
     vray.Render(0, 1, -1)
 
     t_end = datetime.now()
-    log.info(f"Finished render at: {t_end}")
+    log.info("Finished render at: %s", t_end)
     diff = t_end - t_start
-    log.info(f"Render took: {round(diff.total_seconds(), 2)} s")
+    log.info("Render took: %.2f s", diff.total_seconds())
 
     vray.RefreshUI()
 
-def _change_save_path(dirpath: str,
-                      filename: str,
-                      fileending: str,
-                      log: logging.Logger) -> None:
-
-    path = os.path.join(dirpath, filename + fileending)
-    log.info("Output file name: %s", filename + fileending)
-    log.debug("Output file path: %s", path)
-
-    with vray.Scene.Transaction() as t:
-        vray.Scene.SettingsOutput.save_render_path = path
-        vray.Scene.SettingsOutput.img_file = path
-        vray.Scene.SettingsOutput.img_dir = path
-
+def _set_save_path(path: str) -> None:
+    # Each view keeps its own small transaction: the output path
+    # has to be committed before the render that uses it, so one
+    # transaction spanning the whole loop would defer the writes
+    # past the renders. The settings object is bound once instead
+    # of traversing vray.Scene for each of the three writes.
+    with vray.Scene.Transaction():
+        settings_output = vray.Scene.SettingsOutput
+        settings_output.save_render_path = path
+        settings_output.img_file = path
+        settings_output.img_dir = path
+
+@functools.lru_cache(maxsize=None)
 def _determine_carrier(filename: str) -> str:
     segments = filename.split('_')
     carrier = segments[1]
@@ -113,14 +137,22 @@ def _determine_carrier(filename: str) -> str:
 
     return carrier
 
-def _get_date_formatted() -> str:
-    current_datetime = datetime.now()
-    current_day_date = current_datetime.strftime("%y%m%d")
+@functools.lru_cache(maxsize=1)
+def _format_date(ordinal: int) -> str:
+    return date.fromordinal(ordinal).strftime("%y%m%d")
 
-    return current_day_date
+def _get_date_formatted() -> str:
+    # Keyed on the day ordinal, so strftime runs once per day
+    # and the cache rolls over cleanly at midnight.
+    return _format_date(date.today().toordinal())
 
-def _get_output_path() -> str:
-    index = 0
+def _create_output_dir() -> str:
+    '''
+    Create and return today's render directory. The directory
+    is claimed directly with makedirs instead of an isdir probe
+    followed by a separate mkdir, which costs two syscalls and
+    can race against a second running instance.
+    '''
     carrier = _determine_carrier(FILENAME)
     if not carrier:
         print("ERROR: Could not determine a valid carrier.")
@@ -129,45 +161,44 @@ def _get_output_path() -> str:
     print("INFO: Current carrier is: ", carrier )
 
     current_date = _get_date_formatted()
-    out_dir = ''.join((current_date, 'v', str(index)))
-    out_path = os.path.join(BASE_PATH, carrier, 'renderings', out_dir)
-
-    if os.path.isdir(out_path):
-        print('INFO: This directory already exists. A new version will be created.')
-        index = _determine_version_number(carrier)
-        out_dir = ''.join((current_date, 'v', str(index)))
-        out_path = os.path.join(BASE_PATH, carrier, 'renderings', out_dir)
-        print('INFO: Changed directory name to: ', out_dir)
+    renderings_path = RENDERINGS_ROOT[carrier]
 
-    return out_path
+    out_dir = ''.join((current_date, 'v0'))
+    out_path = os.path.join(renderings_path, out_dir)
 
-def _determine_version_number(carrier: str) -> int:
-    latest_dir = _get_latest_entry(os.path.join(BASE_PATH, carrier, 'renderings'))
-    latest_index = int(latest_dir[7])
-    return latest_index + 1
+    try:
+        os.makedirs(out_path)
+        return out_path
+    except FileExistsError:
+        print('INFO: This directory already exists. A new version will be created.')
 
-def _get_latest_entry(path: str) -> str:
-    entry_list = []
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_dir():
-                entry_list.append(entry.name)
+    index = _determine_version_number(carrier)
+    out_dir = ''.join((current_date, 'v', str(index)))
+    out_path = os.path.join(renderings_path, out_dir)
+    print('INFO: Changed directory name to: ', out_dir)
 
-    if not entry_list:
-        return ''
+    os.makedirs(out_path)
 
-    entry_list.sort(reverse=True)
+    return out_path
 
-    return entry_list[0]
+def _determine_version_number(carrier: str) -> int:
+    return 1 + max(_iter_today_versions(carrier, _get_date_formatted()),
+                   default=-1)
 
-def _get_renderfile_name(viewname: str) -> str:
-    segments = viewname.split('_')
-    for seg in segments:
-        if 'name-' in seg:
-            print('name:  ', seg[5:])
-            return seg[5:]
+def _iter_today_versions(carrier: str, date_prefix: str):
+    '''
+    Yield the version numbers of the given day's renderings
+    folders. The regex parses the whole vNN suffix, which also
+    survives more than ten versions per day; everything outside
+    the date is filtered out during the scan.
+    '''
+    version_re = re.compile(rf'^{date_prefix}v(\d+)$')
 
-    return ''
+    with os.scandir(RENDERINGS_ROOT[carrier]) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False) \
+            and (match := version_re.match(entry.name)):
+                yield int(match.group(1))
 
 def _restore_layer_state(state: str) -> bool:
     # RestoreLayerState currently does not work in Rh8!
@@ -209,9 +240,82 @@ def _prepare_vray(log: logging.Logger):
         #vray.Scene.SettingsOutput.img_height = 64
         vray.Scene.SettingsOutput.save_render = 1
         vray.Scene.SettingsOutput.img_noAlpha = 0
+        # The script only waits on the render, so the worker
+        # threads should not run at lowered priority.
+        vray.Scene.SettingsOptions.misc_lowThreadPriority = 0
 
     success = vray.SetDeviceList(vray.RenderEngines.RE_CUDA, [0, 1])
 
+    if not success:
+        log.warning("Could not apply the CUDA device list.")
+
+    for device in vray.GetDeviceList(vray.RenderEngines.RE_CUDA):
+        log.debug("Device enabled after setup: %s - %s",
+                  device.Name, device.UseForRendering)
+
+def _render_cache_key(view: str) -> str:
+    '''
+    Hash of everything a finished frame depends on: the camera
+    pose of the view plus the modification times of the scene
+    file and the render settings. An unchanged key means a
+    stored png of this view is still valid. Returns '' when the
+    key cannot be computed; the view is then simply rendered.
+    '''
+    doc_file = FILEPATH if os.path.isfile(FILEPATH) \
+        else os.path.join(FILEPATH, FILENAME)
+
+    # The view is a named view, not an open viewport, so the
+    # camera cannot be queried by its name. Restore it first and
+    # read the pose from the active viewport; the render restores
+    # the same view again anyway.
+    try:
+        rs.RestoreNamedView(view)
+        state = (rs.ViewCameraTarget(),
+                 rs.ViewCamera(),
+                 os.path.getmtime(VR_RENDERSETTINGS),
+                 os.path.getmtime(doc_file))
+    except (ValueError, OSError):
+        return ''
+
+    return hashlib.blake2b(repr(state).encode(), digest_size=16).hexdigest()
+
+def _reuse_cached_render(out_dir: str,
+                         out_name: str,
+                         cache_key: str,
+                         log: logging.Logger) -> bool:
+    '''
+    Look for the same frame in the previous dated folders and
+    copy it forward when its stored key matches, so unchanged
+    views skip the render entirely.
+    '''
+    parent = os.path.dirname(out_dir)
+    current = os.path.basename(out_dir)
+
+    with os.scandir(parent) as it:
+        candidates = sorted((entry.name for entry in it
+                             if entry.is_dir() and entry.name != current),
+                            reverse=True)
+
+    for folder in candidates:
+        key_path = os.path.join(parent, folder, '.' + out_name + '.key')
+        png_path = os.path.join(parent, folder, out_name + '.png')
+
+        try:
+            with open(key_path, encoding='ascii') as key_file:
+                if key_file.read().strip() != cache_key:
+                    continue
+            shutil.copy2(png_path, os.path.join(out_dir, out_name + '.png'))
+            # The key travels with the frame, so later runs can
+            # match against the newest folder again.
+            shutil.copy2(key_path, os.path.join(out_dir, '.' + out_name + '.key'))
+        except OSError:
+            continue
+
+        log.info("Reused unchanged render of '%s' from: %s", out_name, folder)
+        return True
+
+    return False
+
 def _render_scene(group: str,
                   filepath: str,
                   log: logging.Logger,
@@ -231,35 +335,64 @@ def _render_scene(group: str,
         True on success, False on error
     '''
 
-    group_tag = ''.join(('_', group, '_'))
-
     views = rs.NamedViews()
-    if views:
-        for view in views:
-            if view.startswith('r_') and group_tag in view:
-                log.info("Setting up view: %s", view)
-                out_name = _get_renderfile_name(view)
+    if not views:
+        return True
+
+    # One compiled pattern filters the marked views and the
+    # name- tag is pulled out in the same pass, so each view
+    # string is scanned once instead of three times.
+    view_pattern = re.compile(rf'^r_(?:.*_)?{re.escape(group)}_')
+    name_pattern = re.compile(r'name-([^_]*)')
+
+    targets = []
+    for view in views:
+        if not view_pattern.match(view):
+            continue
+
+        name_match = name_pattern.search(view)
+        if not name_match or not name_match.group(1):
+            return False
+
+        targets.append((view, name_match.group(1)))
+
+    log.info("Found %i views marked for rendering.", len(targets))
 
-                if not out_name:
-                    return False
+    for view, out_name in targets:
+        log.info("Setting up view: %s", view)
+        out_file = out_name + '.png'
+        out_path = os.path.join(filepath, out_file)
+        log.info("Output file name: %s", out_file)
+        log.debug("Output file path: %s", out_path)
 
-                _change_save_path(filepath, out_name, '.png', log)
+        _set_save_path(out_path)
 
-                if do_render:
-                    _render_view(view, log)
+        if do_render:
+            cache_key = _render_cache_key(view)
+
+            if cache_key and _reuse_cached_render(filepath, out_name,
+                                                  cache_key, log):
+                continue
+
+            _render_view(view, log)
+
+            if cache_key:
+                # The leading dot keeps the sidecar out of the file
+                # listings, which skip hidden names.
+                key_path = os.path.join(filepath, '.' + out_name + '.key')
+                with open(key_path, 'w', encoding='ascii') as key_file:
+                    key_file.write(cache_key)
 
     return True
 
 def render_views(view_group: str, do_render: bool = False) -> bool:
     print('Starting rendering script. Logging to file.')
 
-    path = _get_output_path()
+    path = _create_output_dir()
     if not path:
         return False
 
-    os.mkdir(path)
-
-    logger = _setup_logging(path)
+    logger, listener = _setup_logging(path)
     logger.info("VRay Version: %s, Core: %s", vray.Version, vray.VRayVersion)
 
     try:
@@ -268,13 +401,13 @@ def render_views(view_group: str, do_render: bool = False) -> bool:
 
     finally:
         _load_vray_settings(NORMAL_RENDERSETTINGS, logger)
-        _close_logging(logger)
+        _close_logging(logger, listener)
 
     print('Finishing rendering script.')
 
 
-render_views('ex', True)
-
-
 if __name__ == "__main__":
-    pass
+    # Rhino's script runner executes the file as __main__, so
+    # this still starts the render there; a plain import of the
+    # module no longer does.
+    render_views('ex', True)